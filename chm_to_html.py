@@ -1,20 +1,23 @@
 import argparse
+import asyncio
+import functools
 import os
+import shutil
 import subprocess
 import sys
 from pathlib import Path
 
 
+@functools.lru_cache(maxsize=1)
 def find_hh_exe() -> str | None:
     """
     尝试在环境变量 PATH 和系统目录中查找 hh.exe。
+    结果会被缓存，批量解包时不会重复扫描 PATH。
     """
     # 1. 直接假设在 PATH 中
-    for name in ("hh.exe", "HH.EXE"):
-        for path_dir in os.environ.get("PATH", "").split(os.pathsep):
-            candidate = Path(path_dir) / name
-            if candidate.is_file():
-                return str(candidate)
+    found = shutil.which("hh.exe")
+    if found:
+        return found
 
     # 2. 常见系统目录
     system_root = os.environ.get("SystemRoot", r"C:\Windows")
@@ -50,39 +53,106 @@ def decompile_chm(chm_path: Path, output_dir: Path) -> int:
     cmd = [hh, "-decompile", str(output_dir), str(chm_path)]
     print(f"执行命令: {' '.join(cmd)}")
 
+    # 边读边输出 hh.exe 的日志，不在内存中缓存完整输出
     try:
-        proc = subprocess.run(
+        with subprocess.Popen(
             cmd,
-            check=False,
-            capture_output=True,
-        )
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            encoding="gbk",
+            errors="ignore",
+        ) as proc:
+            for line in proc.stdout:
+                sys.stdout.write(line)
+            returncode = proc.wait()
     except OSError as exc:  # noqa: BLE001
         print(f"执行 hh.exe 失败: {exc}", file=sys.stderr)
         return 1
 
-    if proc.stdout:
-        try:
-            print(proc.stdout.decode("gbk", errors="ignore"))
-        except Exception:  # noqa: BLE001
-            # 某些系统下 hh.exe 输出可能不是文本，可以忽略
-            pass
-
-    if proc.stderr:
-        try:
-            msg = proc.stderr.decode("gbk", errors="ignore")
-        except Exception:  # noqa: BLE001
-            msg = str(proc.stderr)
-        if msg.strip():
-            print(msg, file=sys.stderr)
-
-    if proc.returncode != 0:
-        print(f"hh.exe 退出码非 0: {proc.returncode}", file=sys.stderr)
-        return proc.returncode
+    if returncode != 0:
+        print(f"hh.exe 退出码非 0: {returncode}", file=sys.stderr)
+        return returncode
 
     print("CHM 解包完成。")
     return 0
 
 
+async def decompile_many(
+    chm_paths: list[Path], output_dir: Path, concurrency: int = 4
+) -> int:
+    """
+    并发调用多个 hh.exe 批量解包 chm，每个 chm 输出到 output_dir 下的同名子目录。
+    hh.exe 主要受磁盘写入限制，同时运行 3~4 个即可跑满。
+    """
+    # 同名 chm 会解包到同一目录并互相覆盖（Windows 下文件名不区分大小写）
+    seen: dict[str, Path] = {}
+    for chm_path in chm_paths:
+        key = chm_path.stem.casefold()
+        if key in seen:
+            print(
+                f"CHM 文件名重复，输出目录会冲突: {seen[key]} 与 {chm_path}",
+                file=sys.stderr,
+            )
+            return 1
+        seen[key] = chm_path
+
+    hh = find_hh_exe()
+    if not hh:
+        print("未找到 hh.exe，请确认已安装 HTML 帮助查看器，并将其加入 PATH。", file=sys.stderr)
+        return 1
+
+    output_dir = output_dir.resolve()
+    print(f"使用: {hh}")
+    print(f"输出目录: {output_dir}")
+
+    sem = asyncio.Semaphore(concurrency)
+
+    async def _one(chm_path: Path) -> int:
+        chm_path = chm_path.resolve()
+        out = output_dir / chm_path.stem
+        out.mkdir(parents=True, exist_ok=True)
+
+        async with sem:
+            print(f"开始解包: {chm_path} -> {out}")
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    hh,
+                    "-decompile",
+                    str(out),
+                    str(chm_path),
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.STDOUT,
+                )
+            except OSError as exc:  # noqa: BLE001
+                print(f"执行 hh.exe 失败: {chm_path}: {exc}", file=sys.stderr)
+                return 1
+
+            # 必须读空管道，否则输出较多时 hh.exe 会阻塞
+            stdout, _ = await proc.communicate()
+
+        msg = stdout.decode("gbk", errors="ignore").strip()
+        if msg:
+            print(msg)
+        if proc.returncode != 0:
+            print(f"hh.exe 退出码非 0: {chm_path}: {proc.returncode}", file=sys.stderr)
+        else:
+            print(f"解包完成: {chm_path}")
+        return proc.returncode
+
+    results = await asyncio.gather(*(_one(p) for p in chm_paths))
+    return next((rc for rc in results if rc != 0), 0)
+
+
+def _positive_int(value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"需要正整数: {value}")
+    return number
+
+
 def parse_args(argv: list[str]) -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         description="使用 hh.exe 将 CHM 文件解包为 HTML 目录。",
@@ -90,7 +160,11 @@ def parse_args(argv: list[str]) -> argparse.Namespace:
     parser.add_argument(
         "chm",
         type=str,
-        help="要解包的 CHM 文件路径，例如: 设备网络SDK使用手册.chm",
+        nargs="+",
+        help=(
+            "要解包的 CHM 文件路径，例如: 设备网络SDK使用手册.chm；"
+            "指定多个时并发解包，分别输出到输出目录下的同名子目录"
+        ),
     )
     parser.add_argument(
         "-o",
@@ -99,6 +173,13 @@ def parse_args(argv: list[str]) -> argparse.Namespace:
         default="html",
         help="HTML 输出目录（默认: html）",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=_positive_int,
+        default=4,
+        help="同时解包的 CHM 数量（仅指定多个 CHM 时生效，默认: 4）",
+    )
     return parser.parse_args(argv)
 
 
@@ -109,13 +190,16 @@ def main(argv: list[str] | None = None) -> int:
 
     args = parse_args(argv or sys.argv[1:])
 
-    chm_path = Path(args.chm)
-    if not chm_path.is_file():
-        print(f"未找到 CHM 文件: {chm_path}", file=sys.stderr)
-        return 1
+    chm_paths = [Path(p) for p in args.chm]
+    for chm_path in chm_paths:
+        if not chm_path.is_file():
+            print(f"未找到 CHM 文件: {chm_path}", file=sys.stderr)
+            return 1
 
     output_dir = Path(args.output)
-    return decompile_chm(chm_path, output_dir)
+    if len(chm_paths) == 1:
+        return decompile_chm(chm_paths[0], output_dir)
+    return asyncio.run(decompile_many(chm_paths, output_dir, args.jobs))
 
 
 if __name__ == "__main__":
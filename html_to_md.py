@@ -1,112 +1,320 @@
 import argparse
+import codecs
+import hashlib
+import multiprocessing
 import os
 import sys
 import re
+import threading
+from collections.abc import Iterable, Iterator
 from pathlib import Path
+from typing import TypeVar
 
-from bs4 import BeautifulSoup
-from markdownify import markdownify as md
+from lxml import etree
+from lxml import html as lxml_html
+from markdownify import MarkdownConverter
 
 
+_T = TypeVar("_T")
+
 DEFAULT_HTML_ROOT = Path("html")
 
+# 进程池每批分发给工作进程的任务数
+POOL_CHUNKSIZE = 16
 
-ENCODING_CANDIDATES = [
-    "utf-8",
-    "gbk",
-    "gb2312",
-    "gb18030",
-]
+# 写出 Markdown 时使用的缓冲区大小（1 MiB）
+WRITE_BUFFER_SIZE = 1 << 20
 
+# 每个工作进程复用同一个 HTML 解析器；注释和处理指令在解析时即被丢弃。
+# 使用 lxml.html 的解析器（而非 etree.HTMLParser），以便得到带 .body 的 HtmlElement
+_PARSER = lxml_html.HTMLParser(remove_comments=True, remove_pis=True)
 
-def detect_and_read(path: Path) -> str:
+# 只指定 strip，避免同时指定 strip 和 convert 触发异常
+# 转换器在模块导入时创建一次，每个工作进程内复用；
+# markdownify 内部重建 BeautifulSoup 树时使用 lxml 解析器，而非纯 Python 的 html.parser
+_CONVERTER = MarkdownConverter(
+    heading_style="ATX", strip=["span"], bs4_options="lxml"
+)
+
+# 超过该大小（字节）的文件不视为跳转页
+REDIRECT_MAX_SIZE = 2048
+
+# 每个工作进程最多缓存的转换结果条数
+MARKDOWN_CACHE_SIZE = 1024
+
+# 按 HTML 内容哈希缓存的转换结果（进程内有效，无需跨进程同步）
+_MARKDOWN_CACHE: dict[bytes, str] = {}
+
+
+# 带 BOM 的文件直接按 BOM 解码（utf-32 的 BOM 以 utf-16 LE 的 BOM 开头，需排在前面）
+BOM_ENCODINGS = [
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
+# 不可见控制字符（保留常见换行和制表符），解析前在 decode_html 中删除
+_CTRL_BYTES = bytes(c for c in range(32) if c not in b"\t\n\r")
+_CTRL_TRANSLATE = dict.fromkeys(_CTRL_BYTES)
+# 后处理替换表：在删除控制字符的同时将 &nbsp; 替换为空格（一次遍历完成）
+_POSTPROCESS_TRANSLATE = {**_CTRL_TRANSLATE, 0xA0: " "}
+# 内部链接中的 .html 后缀（后接 ")" 或 "#"）
+_HTML_LINK_RE = re.compile(r"\.html([)#])")
+# 连续三个及以上的换行
+_BLANK_LINES_RE = re.compile(r"\n{3,}")
+# 文档开头的 XML 声明（lxml 不接受带 encoding 声明的 str 输入）
+_XML_DECL_RE = re.compile(r"^\s*<\?xml[^>]*\?>", re.I)
+# simple_markdown 中与 markdownify 一致的空白处理规则
+_PRE_LSTRIP_RE = re.compile(r"^[ \n]*\n")
+_NEWLINE_WHITESPACE_RE = re.compile(r"[\t \r\n]*[\r\n][\t \r\n]*")
+_WHITESPACE_RE = re.compile(r"[\t ]+")
+# 跳转页中的 <meta http-equiv="refresh" content="0; url=...">
+_REFRESH_RE = re.compile(rb"<meta[^>]+http-equiv=[\"']?refresh[^>]*>", re.I)
+_REFRESH_URL_RE = re.compile(rb"url\s*=\s*[\"']?([^\"'>\s]+)", re.I)
+# 判断跳转页正文是否为空：先去掉 head/title/script/style 整块，再去掉所有标签
+_NON_BODY_RE = re.compile(rb"<(head|title|script|style)\b.*?</\1\s*>", re.I | re.S)
+_TAG_RE = re.compile(rb"<[^>]*>")
+
+
+def decode_html(data: bytes) -> str:
     """
-    尝试使用多种常见编码读取文件，避免中文乱码。
-    读取失败会抛出异常。
+    识别编码并解码，避免中文乱码，同时删除原始内容中的不可见控制字符。
+    优先按 BOM 解码，其次尝试 utf-8，最后回退到 gb18030（gbk / gb2312 的超集）。
+
+    控制字符必须在解析前删除：lxml 会把原始的 NUL 替换为 U+FFFD，之后无法再识别；
+    由 &#1; 等字符引用产生的控制字符则由 postprocess_markdown 统一删除。
     """
-    last_error: Exception | None = None
-    for enc in ENCODING_CANDIDATES:
-        try:
-            with path.open("r", encoding=enc, errors="strict") as f:
-                return f.read()
-        except UnicodeDecodeError as e:
-            last_error = e
-            continue
+    for bom, enc in BOM_ENCODINGS:
+        if data.startswith(bom):
+            # utf-16/32 中的控制字符不是单字节，只能解码后再删除
+            return data.decode(enc, errors="replace").translate(_CTRL_TRANSLATE)
 
-    # 最后尝试二进制 + 忽略错误，避免完全失败（极少数情况）
+    # utf-8 与 gb18030 的多字节序列不含 0x20 以下的字节，可直接在字节层删除
+    data = data.translate(None, _CTRL_BYTES)
     try:
-        data = path.read_bytes()
-        return data.decode("utf-8", errors="ignore")
-    except Exception as e:  # noqa: BLE001
-        raise RuntimeError(f"无法正确解码文件: {path}") from (last_error or e)
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return data.decode("gb18030", errors="replace")
+
+
+def detect_and_read(path: Path) -> str:
+    """
+    读取文件（只读取一次）并解码为文本，见 decode_html。
+    """
+    return decode_html(path.read_bytes())
 
 
-def clean_soup(soup: BeautifulSoup) -> BeautifulSoup:
+def redirect_stub(data: bytes) -> str | None:
     """
-    删除脚本、样式等无关内容。
+    识别 CHM 中常见的跳转页（<meta http-equiv="refresh" content="0; url=...">），
+    直接生成指向目标的 Markdown，跳过完整的解析和转换；不是跳转页时返回 None。
+    直接在原始字节上匹配，只处理较小、带跳转目标且正文没有任何文字的页面，
+    其余情况（包括仅定时刷新、或跳转页本身带说明文字）都走完整转换，避免丢失内容。
     """
-    for tag in soup(["script", "style", "noscript", "meta", "link"]):
-        tag.decompose()
-    return soup
+    if len(data) > REDIRECT_MAX_SIZE:
+        return None
+    meta = _REFRESH_RE.search(data)
+    if meta is None:
+        return None
+    url = _REFRESH_URL_RE.search(meta.group(0))
+    if url is None:
+        return None
+    text = _TAG_RE.sub(b"", _NON_BODY_RE.sub(b"", data))
+    if text.strip():
+        return None
+
+    # 与 postprocess_markdown 的链接改写一致：.html 改为 .md，链接文字同样使用 .md
+    path, sep, fragment = decode_html(url.group(1)).partition("#")
+    if path.endswith(".html"):
+        path = path[: -len(".html")] + ".md"
+    target = path + sep + fragment
+    return postprocess_markdown(f"[{target}]({target})")
 
 
 def postprocess_markdown(text: str) -> str:
     """
     对 Markdown 文本做一些清洗，减少乱码和奇怪字符。
     """
-    # 替换常见的 &nbsp;
-    text = text.replace("\xa0", " ")
-
-    # 删除不可见控制字符（保留常见换行和制表符）
-    def _filter_char(ch: str) -> bool:
-        code = ord(ch)
-        if ch in ("\n", "\r", "\t"):
-            return True
-        # 可打印 ASCII 或常见的 Unicode 字符
-        return code >= 32
-
-    text = "".join(ch for ch in text if _filter_char(ch))
+    # 替换常见的 &nbsp;，同时删除不可见控制字符（包括由 &#1; 等字符引用产生的）
+    text = text.translate(_POSTPROCESS_TRANSLATE)
 
     # 将内部链接中的 .html 后缀改为 .md
-    text = text.replace(".html)", ".md)")
-    text = text.replace(".html#", ".md#")
+    text = _HTML_LINK_RE.sub(r".md\1", text)
 
     # 合并多余的空行（最多保留两个）
-    text = re.sub(r"\n{3,}", "\n\n", text)
+    text = _BLANK_LINES_RE.sub("\n\n", text)
 
     return text.strip() + "\n"
 
 
+def simple_markdown(body: lxml_html.HtmlElement) -> str | None:
+    """
+    body 只包含单个 <pre>，或只包含若干纯文本 <p> 时，直接生成与 markdownify
+    一致的 Markdown，跳过 markdownify 的通用遍历；其他结构返回 None。
+    """
+    if (body.text or "").strip() or len(body) == 0:
+        return None
+    for child in body:
+        # 子元素内再嵌套标签或子元素之间夹杂文本时走完整转换流程
+        if len(child) or (child.tail or "").strip():
+            return None
+
+    tags = {child.tag for child in body}
+    if tags == {"pre"} and len(body) == 1:
+        text = _PRE_LSTRIP_RE.sub("", body[0].text or "").rstrip(" \n")
+        if not text:
+            return None
+        return f"```\n{text}\n```"
+
+    if tags == {"p"}:
+        paragraphs = []
+        for child in body:
+            text = _NEWLINE_WHITESPACE_RE.sub("\n", child.text or "")
+            text = _WHITESPACE_RE.sub(" ", text)
+            text = text.replace("*", r"\*").replace("_", r"\_")
+            text = text.lstrip(" \t\r\n").rstrip()
+            if text:
+                paragraphs.append(text)
+        return "\n\n".join(paragraphs)
+
+    return None
+
+
 def html_to_markdown(html: str) -> str:
-    soup = BeautifulSoup(html, "lxml")
-    soup = clean_soup(soup)
-
-    body = soup.body or soup
-    # 只指定 strip，避免同时指定 strip 和 convert 触发异常
-    markdown = md(
-        str(body),
-        heading_style="ATX",
-        strip=["span"],
+    # 文本已解码，XHTML 页面开头的编码声明没有意义且会导致 lxml 报错
+    html = _XML_DECL_RE.sub("", html, count=1)
+    try:
+        tree = lxml_html.fromstring(html, parser=_PARSER)
+    except etree.ParserError:
+        # 空文档（或只有注释）无可转换内容
+        return postprocess_markdown("")
+
+    # 直接在 lxml 树上删除脚本、样式等无关内容，保留其后的文本
+    etree.strip_elements(
+        tree, "script", "style", "noscript", "meta", "link", with_tail=False
     )
+
+    body = tree.body if tree.body is not None else tree
+    markdown = simple_markdown(body)
+    if markdown is None:
+        markdown = _CONVERTER.convert(
+            etree.tostring(body, encoding="unicode", method="html")
+        )
     return postprocess_markdown(markdown)
 
 
-def process_file(src_path: Path, html_root: Path, md_root: Path) -> None:
-    rel = src_path.relative_to(html_root)
-    dst_path = md_root / rel.with_suffix(".md")
+def html_to_markdown_cached(html: str) -> str:
+    """
+    同 html_to_markdown，但内容完全相同的页面只转换一次。
+    """
+    key = hashlib.blake2b(html.encode("utf-8", "ignore"), digest_size=16).digest()
+    markdown = _MARKDOWN_CACHE.get(key)
+    if markdown is None:
+        markdown = html_to_markdown(html)
+        if len(_MARKDOWN_CACHE) >= MARKDOWN_CACHE_SIZE:
+            # 缓存已满时淘汰最早加入的一条（dict 保持插入顺序）
+            _MARKDOWN_CACHE.pop(next(iter(_MARKDOWN_CACHE)))
+        _MARKDOWN_CACHE[key] = markdown
+    return markdown
+
+
+def process_file(src_path: Path, dst_path: Path, force: bool = False) -> bool:
+    """
+    转换单个文件；返回是否实际进行了转换（未变化而跳过时返回 False）。
+    输出路径及其目录由 main 在遍历时统一计算和创建。
+    """
+    # 输出比源文件新时跳过，重复运行只转换有变化的文件
+    if not force:
+        try:
+            if dst_path.stat().st_mtime_ns >= src_path.stat().st_mtime_ns:
+                return False
+        except FileNotFoundError:
+            pass
+
+    data = src_path.read_bytes()
+    md_text = redirect_stub(data)
+    if md_text is None:
+        md_text = html_to_markdown_cached(decode_html(data))
+    with open(dst_path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+        f.write(md_text.encode("utf-8"))
+    return True
+
+
+def _worker(
+    task: tuple[Path, Path, Path, bool, str | None],
+) -> tuple[Path, Path, bool, str | None]:
+    """
+    进程池任务入口：转换单个文件，返回 (源路径, 相对路径, 是否已转换, 错误信息)。
+    异常在子进程内捕获，避免单个文件失败中断整个批次。
+    子进程不直接输出，进度统一由主进程打印，避免多个进程争用 stdout。
+    """
+    src_path, rel, dst_path, force, dir_error = task
+    # 输出目录创建失败时不再转换，原样作为该文件的错误返回
+    if dir_error is not None:
+        return src_path, rel, False, dir_error
+    try:
+        converted = process_file(src_path, dst_path, force)
+    except Exception as e:  # noqa: BLE001
+        return src_path, rel, False, str(e)
+    return src_path, rel, converted, None
 
-    # 确保输出目录存在
-    dst_path.parent.mkdir(parents=True, exist_ok=True)
 
-    print(f"转换: {rel}")
-    html_text = detect_and_read(src_path)
-    md_text = html_to_markdown(html_text)
-    dst_path.write_text(md_text, encoding="utf-8")
+def _throttled(items: Iterable[_T], slots: threading.Semaphore) -> Iterator[_T]:
+    """
+    每产出一项前先占用一个名额，名额由消费结果的一方释放，实现背压。
+    """
+    for item in items:
+        slots.acquire()
+        yield item
 
 
-def collect_html_files(root: Path, subdir: Path | None = None) -> list[Path]:
+def iter_html(base: Path, rel_prefix: Path = Path()) -> Iterator[tuple[Path, Path]]:
+    """
+    递归遍历目录，逐个产出 (.html 文件路径, 相对根目录的路径)。
+    直接复用 os.scandir 返回的类型信息，避免重复 stat；
+    相对路径随递归逐级拼接，无需再调用 relative_to。
+    """
+    try:
+        entries = os.scandir(base)
+    except OSError:
+        # 与 os.walk 一致：无法访问的目录直接跳过
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_html(Path(entry.path), rel_prefix / entry.name)
+            elif entry.name.lower().endswith(".html") and entry.is_file():
+                yield Path(entry.path), rel_prefix / entry.name
+
+
+def plan_outputs(
+    html_files: Iterable[tuple[Path, Path]], md_root: Path
+) -> Iterator[tuple[Path, Path, Path, str | None]]:
+    """
+    为每个文件计算输出路径，产出 (源路径, 相对路径, 输出路径, 目录错误)。
+    遍历过程中每个输出目录只执行一次 mkdir；创建失败时记录错误，
+    该目录下的文件都带上这条错误，由调用方按单个文件的失败处理。
     """
-    收集需要转换的 HTML 文件列表。
+    dir_errors: dict[Path, str | None] = {}
+    for src_path, rel in html_files:
+        dst_path = md_root / rel.with_suffix(".md")
+        out_dir = dst_path.parent
+        if out_dir not in dir_errors:
+            try:
+                out_dir.mkdir(parents=True, exist_ok=True)
+                dir_errors[out_dir] = None
+            except OSError as e:
+                dir_errors[out_dir] = str(e)
+        yield src_path, rel, dst_path, dir_errors[out_dir]
+
+
+def collect_html_files(
+    root: Path, subdir: Path | None = None
+) -> Iterator[tuple[Path, Path]]:
+    """
+    收集需要转换的 HTML 文件（惰性产出 (文件路径, 相对 root 的路径)，边遍历边转换）。
 
     - root: HTML 根目录（例如 chm_to_html 的输出目录）
     - subdir: 可选子目录（相对 root 的相对路径），仅转换该子目录下的文件
@@ -117,15 +325,9 @@ def collect_html_files(root: Path, subdir: Path | None = None) -> list[Path]:
 
     if not base.exists():
         print(f"未找到目录: {base}", file=sys.stderr)
-        return []
-
-    html_files: list[Path] = []
-    for r, _dirs, files in os.walk(base):
-        for name in files:
-            if name.lower().endswith(".html"):
-                html_files.append(Path(r) / name)
+        return iter(())
 
-    return html_files
+    return iter_html(base, base.relative_to(root))
 
 
 def parse_args(argv: list[str]) -> argparse.Namespace:
@@ -155,6 +357,17 @@ def parse_args(argv: list[str]) -> argparse.Namespace:
         default=None,
         help="Markdown 输出根目录（默认与 HTML 根目录相同，例如: md 或 out_md）",
     )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="强制重新转换所有文件（默认跳过 .md 比 .html 新的文件）",
+    )
+    parser.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="不逐个输出已转换的文件，只输出错误和汇总信息",
+    )
     return parser.parse_args(argv)
 
 
@@ -169,21 +382,51 @@ def main(argv: list[str] | None = None) -> int:
         print(f"未找到 HTML 根目录: {html_root}", file=sys.stderr)
         return 1
 
-    html_files = collect_html_files(html_root, subdir)
+    # 输出路径按相对 root 的路径计算，子目录不能跳出根目录（例如 ../xxx）
+    if subdir is not None and not (html_root / subdir).resolve().is_relative_to(
+        html_root
+    ):
+        print(f"子目录不在 HTML 根目录下: {html_root / subdir}", file=sys.stderr)
+        return 1
 
-    if not html_files:
+    outputs = plan_outputs(collect_html_files(html_root, subdir), md_root)
+
+    # 解析与转换均为 CPU 密集型，使用多进程绕开 GIL
+    tasks = (
+        (src, rel, dst, args.force, dir_error)
+        for src, rel, dst, dir_error in outputs
+    )
+    procs = os.cpu_count() or 1
+    # imap_unordered 的任务线程会立即读完整个输入，本身不限流；
+    # 用信号量限制在途任务数，每取回一个结果才放行一个新任务
+    max_pending = procs * POOL_CHUNKSIZE * 2
+    slots = threading.Semaphore(max_pending)
+    count = 0
+    with multiprocessing.Pool(procs) as pool:
+        # 单个文件较小，chunksize > 1 以摊薄进程间通信开销；
+        # 结果按完成顺序返回，遍历、转换与输出可以重叠进行
+        results = pool.imap_unordered(
+            _worker, _throttled(tasks, slots), chunksize=POOL_CHUNKSIZE
+        )
+        try:
+            for path, rel, converted, err in results:
+                slots.release()
+                count += 1
+                if err is not None:
+                    print(f"处理失败: {path}: {err}", file=sys.stderr)
+                elif converted and not args.quiet:
+                    print(f"转换: {rel}")
+        finally:
+            # 提前退出（如 Ctrl+C）时放行任务线程，避免关闭进程池时卡在 acquire 上
+            slots.release(max_pending)
+
+    if count == 0:
         if subdir is not None:
             print(f"未在 {html_root / subdir} 下找到任何 .html 文件。")
         else:
             print(f"未在 {html_root} 下找到任何 .html 文件。")
         return 0
 
-    for path in sorted(html_files):
-        try:
-            process_file(path, html_root, md_root)
-        except Exception as e:  # noqa: BLE001
-            print(f"处理失败: {path}: {e}", file=sys.stderr)
-
     print("全部处理完成。")
     return 0
 